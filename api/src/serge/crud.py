@@ -4,29 +4,39 @@ from typing import List, Optional
 
 from serge.schema import user as user_schema
 from serge.utils.security import get_password_hash
-from sqlalchemy.orm import Session
+from sqlalchemy import delete, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
 
 from serge.models import user as user_model
 
 
-def get_user(db: Session, username: str) -> Optional[user_schema.User]:
-    return Mappers.user_db_to_view(
-        db.query(user_model.User).filter(user_model.User.username == username).first(),
-        include_auth=True,
-    )
+# Load the collections read by Mappers.user_db_to_view in one IN query each
+user_load_options = (selectinload(user_model.User.chats), selectinload(user_model.User.auth))
 
 
-def get_user_by_email(db: Session, email: str) -> Optional[user_schema.User]:
-    return Mappers.user_db_to_view(db.query(user_model.User).filter(user_model.User.email == email).first())
+async def get_user(db: AsyncSession, username: str) -> Optional[user_schema.User]:
+    result = await db.execute(select(user_model.User).options(*user_load_options).filter(user_model.User.username == username))
+    return Mappers.user_db_to_view(result.scalar_one_or_none(), include_auth=True)
 
 
-def get_users(db: Session, skip: int = 0, limit: int = 100) -> List[user_schema.User]:
-    return [Mappers.user_db_to_view(u) for u in db.query(user_model.User).offset(skip).limit(limit).all()]
+async def get_user_by_id(db: AsyncSession, user_id: uuid.UUID) -> Optional[user_schema.User]:
+    return Mappers.user_db_to_view(await db.get(user_model.User, user_id, options=user_load_options), include_auth=True)
 
 
-def create_user(db: Session, ua: user_schema.UserAuth) -> Optional[user_schema.User]:
+async def get_user_by_email(db: AsyncSession, email: str) -> Optional[user_schema.User]:
+    result = await db.execute(select(user_model.User).filter(user_model.User.email == email))
+    return Mappers.user_db_to_view(result.unique().scalars().first())
+
+
+async def get_users(db: AsyncSession, skip: int = 0, limit: int = 100) -> List[user_schema.User]:
+    result = await db.execute(select(user_model.User).offset(skip).limit(limit))
+    return [Mappers.user_db_to_view(u) for u in result.unique().scalars().all()]
+
+
+async def create_user(db: AsyncSession, ua: user_schema.UserAuth) -> Optional[user_schema.User]:
     # Check already exists
-    if get_user(db, ua.username):
+    if await get_user(db, ua.username):
         logging.error(f"Tried to create new user, but already exists: {ua.username}")
         return None
 
@@ -39,32 +49,38 @@ def create_user(db: Session, ua: user_schema.UserAuth) -> Optional[user_schema.U
     db_user, db_user_auth = Mappers.user_view_to_db(None, ua)
     db.add(db_user_auth)
     db.add(db_user)
-    db.commit()
+    await db.commit()
     return Mappers.user_db_to_view(db_user)
 
 
-def update_user(db: Session, u: user_schema.User) -> Optional[user_schema.User]:
-    user = db.query(user_model.User).filter(user_model.User.username == u.username).first()
+async def update_user(db: AsyncSession, u: user_schema.User) -> Optional[user_schema.User]:
+    result = await db.execute(select(user_model.User).filter(user_model.User.username == u.username))
+    user = result.unique().scalars().first()
     if not user:
         return None
     for k, v in u.dict().items():
         if k in ["auth", "chats"]:
             continue
         setattr(user, k, v)
-    db.commit()
+    await db.commit()
     return user
 
 
-def create_chat(db: Session, chat: user_schema.Chat):
+async def create_chat(db: AsyncSession, chat: user_schema.Chat):
     c = user_model.Chat(owner=chat.owner, chat_id=chat.chat_id)
     db.add(c)
-    db.commit()
+    await db.commit()
+
+
+async def remove_chat(db: AsyncSession, chat: user_schema.Chat):
+    c = (await db.execute(select(user_model.Chat).filter(user_model.Chat.chat_id == chat.chat_id))).scalars().one()
+    await db.delete(c)
+    await db.commit()
 
 
-def remove_chat(db: Session, chat: user_schema.Chat):
-    c = db.query(user_model.Chat).filter(user_model.Chat.chat_id == chat.chat_id).one()
-    db.delete(c)
-    db.commit()
+async def remove_chats(db: AsyncSession, chats: List[user_schema.Chat]):
+    await db.execute(delete(user_model.Chat).where(user_model.Chat.chat_id.in_([c.chat_id for c in chats])))
+    await db.commit()
 
 
 class Mappers:
@@ -3,17 +3,40 @@ import uuid
 
 from serge.models.settings import Settings
 from serge.models.user import User, UserAuth
-from sqlalchemy import create_engine
-from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy import select
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 
 settings = Settings()
 
-engine = create_engine(settings.SERGE_DATABASE_URL, connect_args={"check_same_thread": False})
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+}
 
 
-def seed_db(db: Session):
-    sys_u = db.query(User).filter(User.username == "system").first()
+def get_async_url(url: str):
+    db_url = make_url(url)
+    return db_url.set(drivername=ASYNC_DRIVERS.get(db_url.drivername, db_url.drivername))
+
+
+database_url = get_async_url(settings.SERGE_DATABASE_URL)
+is_sqlite = database_url.get_backend_name() == "sqlite"
+connect_args = {"check_same_thread": False} if is_sqlite else {}
+# aiosqlite gets a NullPool, which rejects sizing arguments; SQLite has no connection handshake worth pooling anyway
+pool_args = {} if is_sqlite else {"pool_size": 25, "max_overflow": 25, "pool_recycle": 3600}
+
+engine = create_async_engine(
+    database_url,
+    connect_args=connect_args,
+    pool_pre_ping=True,
+    **pool_args,
+)
+SessionLocal = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
+
+
+async def seed_db(db: AsyncSession):
+    sys_u = (await db.execute(select(User).filter(User.username == "system"))).unique().scalars().first()
     if sys_u:
         return
     system_user = User(
@@ -27,5 +50,5 @@ def seed_db(db: Session):
         auth=[UserAuth(secret="", auth_type=0)],
     )
     db.add(system_user)
-    db.commit()
+    await db.commit()
     logging.info("System user created")
@@ -45,9 +45,6 @@ origins = [
     "http://localhost:9124",
 ]
 
-# Seed the database
-user_models.Base.metadata.create_all(bind=engine)
-
 app = FastAPI(title="Serge", version="0.0.1", description=description, tags_metadata=tags_metadata)
 
 api_app = FastAPI(title="Serge API")
@@ -92,8 +89,12 @@ async def start_database():
     for file in files:
         os.remove(WEIGHTS + file)
 
-    db = SessionLocal()
-    seed_db(db)
+    # Seed the database
+    async with engine.begin() as conn:
+        await conn.run_sync(user_models.Base.metadata.create_all)
+
+    async with SessionLocal() as db:
+        await seed_db(db)
 
 
 app.add_middleware(
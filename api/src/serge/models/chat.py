@@ -1,9 +1,15 @@
 from datetime import datetime
 from uuid import uuid4
 
+import orjson
 from pydantic import BaseModel, Field
 
 
+def orjson_dumps(v, *, default):
+    # orjson.dumps returns bytes, pydantic expects str
+    return orjson.dumps(v, default=default).decode()
+
+
 class ChatParameters(BaseModel):
     model_path: str
     n_ctx: int
@@ -13,9 +19,8 @@ class ChatParameters(BaseModel):
     # f16_kv: bool
     # logits_all: bool
     # vocab_only: bool
-    # use_mlock: bool
     n_threads: int
-    # n_batch: int
+    n_batch: int = 512
     last_n_tokens_size: int
     max_tokens: int
     temperature: float
@@ -34,3 +39,7 @@ class Chat(BaseModel):
     created: datetime = Field(default_factory=datetime.now)
     owner: str = Field("system")
     params: ChatParameters
+
+    class Config:
+        json_loads = orjson.loads
+        json_dumps = orjson_dumps
@@ -16,7 +16,7 @@ class User(Base):
     default_prompt = Column(String)
     is_active = Column(Boolean, default=True)
 
-    auth = relationship("UserAuth", back_populates="user", lazy="joined")
+    auth = relationship("UserAuth", back_populates="user", lazy="selectin")
     chats = relationship("Chat", back_populates="user", lazy="joined")
 
 
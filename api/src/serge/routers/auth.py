@@ -1,45 +1,56 @@
 import logging
+import threading
+import uuid
 from datetime import timedelta
 from typing import Optional
 
+from cachetools import TTLCache
 from fastapi import APIRouter, Depends, HTTPException, Request, Response, status
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from jose import JWTError
-from serge.crud import get_user
+from serge.crud import get_user, get_user_by_id
 from serge.database import SessionLocal
 from serge.schema.user import Token, User
 from serge.models.settings import Settings
 from serge.utils.security import create_access_token, decode_access_token, verify_password
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 settings = Settings()
 
+# Decoded usernames keyed by raw token, so a session cookie is not re-verified on every request.
+# Kept well below SERGE_SESSION_EXPIRY; invalid tokens are never stored.
+_token_cache = TTLCache(maxsize=4096, ttl=5)
+_token_cache_lock = threading.Lock()
+
+# Tokens that recently failed validation. Stale cookies are resent by every open tab, and the
+# cookie was already cleared on the first failure, so repeats go straight to the system user.
+_bad_token_cache = TTLCache(maxsize=4096, ttl=60)
+
+# The system user row never changes, so remember its primary key after the first lookup
+_system_user_id: Optional[uuid.UUID] = None
+
 auth_router = APIRouter(
     prefix="/auth",
     tags=["auth"],
 )
 
 
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 
-def authenticate_user(username: str, password: str, db: Session) -> Optional[User]:
-    user = get_user(db, username)
+async def authenticate_user(username: str, password: str, db: AsyncSession) -> Optional[User]:
+    user = await get_user(db, username)
     if not user:
         return None
     # Users may have multipe ways to authenticate
-    auths = [a.auth_type for a in user.auth]
+    auths = {a.auth_type: a for a in user.auth}
     if 0 in auths:  # Default user, passwordless
         return user
     if 1 in auths:  # Password auth
-        secret = [x for x in user.auth if x.auth_type == 1][0].secret
-        if verify_password(password, secret):
+        if verify_password(password, auths[1].secret):
             return user
     if 2 in auths:  # todo future auths
         pass
@@ -50,9 +61,9 @@ def authenticate_user(username: str, password: str, db: Session) -> Optional[Use
 async def login_for_access_token(
     response: Response,
     form_data: OAuth2PasswordRequestForm = Depends(),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
-    user = authenticate_user(form_data.username, form_data.password, db)
+    user = await authenticate_user(form_data.username, form_data.password, db)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -72,37 +83,62 @@ async def logout(response: Response):
     return {"message": "Logged out successfully"}
 
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)) -> User:
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)) -> User:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        username = decode_access_token(token)
-        if username is None:
+    with _token_cache_lock:
+        username = _token_cache.get(token)
+
+    if username is None:
+        try:
+            username = decode_access_token(token)
+            if username is None:
+                raise credentials_exception
+        except JWTError as e:
+            logging.exception(e)
             raise credentials_exception
-    except JWTError as e:
-        logging.exception(e)
-        raise credentials_exception
 
-    user = get_user(db, username)
+        with _token_cache_lock:
+            _token_cache[token] = username
+
+    user = await get_user(db, username)
 
     if user is None:
         raise credentials_exception
     return user
 
 
-async def get_current_active_user(request: Request, response: Response, db: Session = Depends(get_db)) -> User:
+async def _get_system_user(db: AsyncSession) -> Optional[User]:
+    global _system_user_id
+    if _system_user_id is not None:
+        return await get_user_by_id(db, _system_user_id)
+
+    user = await get_user(db, "system")
+    if user:
+        _system_user_id = user.id
+    return user
+
+
+async def get_current_active_user(request: Request, response: Response, db: AsyncSession = Depends(get_db)) -> User:
     token = request.cookies.get("token")
 
     if not token:
-        return get_user(db, "system")
+        return await _get_system_user(db)
+
+    with _token_cache_lock:
+        known_bad = token in _bad_token_cache
+    if known_bad:
+        return await _get_system_user(db)
 
     u = None
     try:
         u = await get_current_user(token, db)
     except HTTPException:
+        with _token_cache_lock:
+            _bad_token_cache[token] = True
         await logout(response)
-        u = get_user(db, "system")
+        u = await _get_system_user(db)
     return u
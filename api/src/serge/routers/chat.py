@@ -1,20 +1,27 @@
+import asyncio
 import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from typing import Optional
 
+import orjson
+from cachetools import TTLCache
 from fastapi import APIRouter, Depends, HTTPException, status
 from langchain.memory import RedisChatMessageHistory
-from langchain.schema import AIMessage, HumanMessage, SystemMessage, messages_to_dict
-from llama_cpp import Llama
+from langchain.schema import AIMessage, HumanMessage, SystemMessage, messages_from_dict, messages_to_dict
+from llama_cpp import Llama, LlamaRAMCache
 from loguru import logger
-from redis import Redis
-from serge.crud import create_chat, remove_chat, update_user
+from redis import ConnectionPool, Redis
+from serge.crud import create_chat, remove_chat, remove_chats, update_user
 from serge.database import SessionLocal
 from serge.models.chat import Chat, ChatParameters
 from serge.routers.auth import get_current_active_user
 from serge.schema.user import Chat as UserChat
 from serge.schema.user import User
 from serge.utils.stream import get_prompt
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from sse_starlette.sse import EventSourceResponse
 
 chat_router = APIRouter(
@@ -22,6 +29,24 @@ chat_router = APIRouter(
     tags=["chat"],
 )
 
+REDIS_POOL = ConnectionPool(host="localhost", port=6379, decode_responses=False, max_connections=64)
+redis_client = Redis(connection_pool=REDIS_POOL)
+
+# Loaded models, most recently used last. Loading weights dominates time to first token, so keep a few around.
+LLAMA_CACHE_SIZE = 2
+# Saved prompt states per loaded model. Each entry is a KV cache copy (about 0.5 MiB per token for a 7B model),
+# so this adds up to LLAMA_CACHE_SIZE * LLAMA_STATE_CACHE_BYTES of RAM per process on top of the weights.
+LLAMA_STATE_CACHE_BYTES = 1 << 30
+_llama_cache: OrderedDict[tuple, Llama] = OrderedDict()
+_llama_cache_lock = asyncio.Lock()
+
+# Model loading and inference run here so they don't block the event loop.
+# A single worker keeps concurrent generations from oversubscribing the CPU/GPU.
+LLAMA_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="llama")
+
+# Parsed chat params by chat id. Params never change after creation, entries are dropped when the chat is deleted.
+_chat_cache = TTLCache(maxsize=1024, ttl=30)
+
 unauth_error = HTTPException(
     status_code=status.HTTP_401_UNAUTHORIZED,
     detail="Unauthorized",
@@ -29,18 +54,63 @@ unauth_error = HTTPException(
 )
 
 
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
+
+
+def _history_key(chat_id: str) -> str:
+    # Same key RedisChatMessageHistory uses for its message list
+    return f"message_store:{chat_id}"
+
+
+def _history(chat_id: str) -> RedisChatMessageHistory:
+    # langchain opens its own client from a URL; swap in the shared pool before any command is sent
+    history = RedisChatMessageHistory(chat_id)
+    history.redis_client = redis_client
+    return history
+
+
+def _user_owns_chat(u: User, chat_id: str) -> bool:
+    return any(x.chat_id == chat_id for x in u.chats)
+
+
+async def _get_llama(params: ChatParameters) -> Llama:
+    llama_params = {
+        "model_path": f"/usr/src/app/weights/{params.model_path}.bin",
+        "n_ctx": params.n_ctx,
+        "n_batch": params.n_batch,
+        "n_gpu_layers": params.n_gpu_layers,
+        "n_threads": params.n_threads,
+        "last_n_tokens_size": params.last_n_tokens_size,
+        "use_mmap": True,
+        "use_mlock": False,
+    }
+    key = tuple(llama_params.values())
+
+    async with _llama_cache_lock:
+        if key in _llama_cache:
+            _llama_cache.move_to_end(key)
+            return _llama_cache[key]
+
+        logger.info(f"Loading model {llama_params['model_path']}")
+        llama = await asyncio.get_running_loop().run_in_executor(LLAMA_EXECUTOR, partial(Llama, **llama_params))
+        # Keeps evaluated prompt states so follow-up questions only evaluate the new tokens,
+        # at the cost of a state copy after every completion and the memory bounded above
+        llama.set_cache(LlamaRAMCache(capacity_bytes=LLAMA_STATE_CACHE_BYTES))
+        _llama_cache[key] = llama
+        if len(_llama_cache) > LLAMA_CACHE_SIZE:
+            _llama_cache.popitem(last=False)
+        return llama
 
 
 def _try_get_chat(client, chat_id):
     if not client.sismember("chats", chat_id):
         raise ValueError("Chat does not exist")
 
+    if chat := _chat_cache.get(chat_id):
+        return chat
+
     chat_raw = client.get(f"chat:{chat_id}")
     chat = Chat.parse_raw(chat_raw)
 
@@ -48,13 +118,37 @@ def _try_get_chat(client, chat_id):
     if not hasattr(chat, "owner"):
         chat.owner = "system"
 
+    _chat_cache[chat_id] = chat
     return chat
 
 
+def _fetch_chat_dict(chat_id: str) -> dict:
+    chat = _chat_cache.get(chat_id)
+
+    # existence check, full history and params (unless cached) in a single round-trip
+    with redis_client.pipeline(transaction=False) as pipe:
+        pipe.sismember("chats", chat_id)
+        pipe.lrange(_history_key(chat_id), 0, -1)
+        if chat is None:
+            pipe.get(f"chat:{chat_id}")
+        exists, history_raw, *chat_raw = pipe.execute()
+
+    if not exists:
+        raise ValueError("Chat does not exist")
+
+    if chat is None:
+        chat = _chat_cache[chat_id] = Chat.parse_raw(chat_raw[0])
+
+    chat_dict = chat.dict()
+    # messages are pushed to the head of the list, so the oldest one comes last
+    chat_dict["history"] = messages_to_dict(messages_from_dict([orjson.loads(m) for m in reversed(history_raw)]))
+    return chat_dict
+
+
 @chat_router.post("/")
 async def create_new_chat(
     u: User = Depends(get_current_active_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     model: str = "7B",
     temperature: float = 0.1,
     top_k: int = 50,
@@ -66,12 +160,11 @@ async def create_new_chat(
     repeat_penalty: float = 1.3,
     init_prompt: str = "Below is an instruction that describes a task. Write a response that appropriately completes the request.",
     n_threads: int = 4,
+    n_batch: int = 512,
 ):
     if not os.path.exists(f"/usr/src/app/weights/{model}.bin"):
         raise ValueError(f"Model can't be found: /usr/src/app/weights/{model}.bin")
 
-    client = Redis(host="localhost", port=6379, decode_responses=False)
-
     params = ChatParameters(
         model_path=model,
         temperature=temperature,
@@ -83,25 +176,23 @@ async def create_new_chat(
         last_n_tokens_size=repeat_last_n,
         repeat_penalty=repeat_penalty,
         n_threads=n_threads,
+        n_batch=n_batch,
         init_prompt=init_prompt,
     )
     # create the chat
     chat = Chat(owner=u.username, params=params)
 
-    # store the parameters
-    client.set(f"chat:{chat.id}", chat.json())
-
     uc = UserChat(chat_id=chat.id, owner=u.username)
-    create_chat(db, uc)
+    await create_chat(db, uc)
     u.chats.append(uc)
-    update_user(db, u)
-
-    # create the message history
-    history = RedisChatMessageHistory(chat.id)
-    history.append(SystemMessage(content=init_prompt))
+    await update_user(db, u)
 
-    # add the key to the set of chats
-    client.sadd("chats", chat.id)
+    # store the parameters, the message history and the key in the set of chats in one round-trip
+    with redis_client.pipeline(transaction=False) as pipe:
+        pipe.set(f"chat:{chat.id}", chat.json())
+        pipe.lpush(_history_key(chat.id), orjson.dumps(messages_to_dict([SystemMessage(content=init_prompt)])[0]))
+        pipe.sadd("chats", chat.id)
+        pipe.execute()
 
     return chat.id
 
@@ -110,50 +201,51 @@ async def create_new_chat(
 async def get_all_chats(u: User = Depends(get_current_active_user)):
     res = []
 
-    chats = sorted(
-        [await get_specific_chat(x.chat_id, u) for x in u.chats],
-        key=lambda x: x["created"],
-        reverse=True,
-    )
-
-    for chat in chats:
+    chat_ids = [x.chat_id for x in u.chats]
+    if not chat_ids:
+        return res
+
+    # fetch every chat and the latest message of each history in a single round-trip
+    with redis_client.pipeline(transaction=False) as pipe:
+        pipe.mget([f"chat:{chat_id}" for chat_id in chat_ids])
+        for chat_id in chat_ids:
+            pipe.lindex(_history_key(chat_id), 0)
+        chats_raw, *last_messages = pipe.execute()
+
+    for chat_raw, last_message in zip(chats_raw, last_messages):
+        if chat_raw is None:
+            continue
+        chat = Chat.parse_raw(chat_raw)
         try:
-            subtitle = chat["history"][-1]["data"]["content"]
-        except (KeyError, IndexError):
+            subtitle = orjson.loads(last_message)["data"]["content"]
+        except (TypeError, KeyError):
             subtitle = ""
         res.append(
             {
-                "id": chat["id"],
-                "created": chat["created"],
-                "model": chat["params"]["model_path"],
+                "id": chat.id,
+                "created": chat.created,
+                "model": chat.params.model_path,
                 "subtitle": subtitle,
             }
         )
 
-    return res
+    return sorted(res, key=lambda x: x["created"], reverse=True)
 
 
 @chat_router.get("/{chat_id}")
 async def get_specific_chat(chat_id: str, u: User = Depends(get_current_active_user)):
-    client = Redis(host="localhost", port=6379, decode_responses=False)
-
-    if chat_id not in [x.chat_id for x in u.chats]:
+    if not _user_owns_chat(u, chat_id):
         raise unauth_error
 
-    chat = _try_get_chat(client, chat_id)
-
-    history = RedisChatMessageHistory(chat.id)
-    chat_dict = chat.dict()
-    chat_dict["history"] = messages_to_dict(history.messages)
-    return chat_dict
+    return _fetch_chat_dict(chat_id)
 
 
 @chat_router.get("/{chat_id}/history")
 async def get_chat_history(chat_id: str, u: User = Depends(get_current_active_user)):
-    if chat_id not in [x.chat_id for x in u.chats]:
+    if not _user_owns_chat(u, chat_id):
         raise unauth_error
 
-    history = RedisChatMessageHistory(chat_id)
+    history = _history(chat_id)
     return messages_to_dict(history.messages)
 
 
@@ -162,75 +254,82 @@ async def delete_or_stop_prompt(chat_id: str, idx: int, u: User = Depends(get_cu
     if idx < 0:
         raise ValueError("Index cannot be negative")
 
-    if chat_id not in [x.chat_id for x in u.chats]:
+    if not _user_owns_chat(u, chat_id):
         raise unauth_error
 
-    history = RedisChatMessageHistory(chat_id)
-    client = Redis(host="localhost", port=6379, decode_responses=False)
-
-    if idx >= len(history.messages):
-        client.set(f"stop_generation:{chat_id}", "1", ex=10)
-        if client.get(f"has_generated:{chat_id}"):
-            client.delete(f"has_generated:{chat_id}")
+    history_key = _history_key(chat_id)
+    if idx >= redis_client.llen(history_key):
+        redis_client.set(f"stop_generation:{chat_id}", "1", ex=10)
+        if redis_client.get(f"has_generated:{chat_id}"):
+            redis_client.delete(f"has_generated:{chat_id}")
             logger.info("Stopping response generation")
             return {"message": "Stopping response generation"}
         else:
             logger.info("Preventing response generation")
             return {"message": "Preventing response generation"}
 
-    messages = history.messages.copy()[:idx]
-    history.clear()
-
-    for message in messages:
-        history.append(message)
+    # messages are pushed to the head of the list, so keeping the first idx means keeping the tail
+    if idx == 0:
+        redis_client.delete(history_key)
+    else:
+        redis_client.ltrim(history_key, -idx, -1)
 
     return True
 
 
 @chat_router.delete("/{chat_id}")
-async def delete_chat(chat_id: str, u: User = Depends(get_current_active_user), db: Session = Depends(get_db)):
-    client = Redis(host="localhost", port=6379, decode_responses=False)
-    if chat_id not in [x.chat_id for x in u.chats]:
+async def delete_chat(chat_id: str, u: User = Depends(get_current_active_user), db: AsyncSession = Depends(get_db)):
+    if not _user_owns_chat(u, chat_id):
         raise unauth_error
 
-    if not client.sismember("chats", chat_id):
+    if not redis_client.sismember("chats", chat_id):
         raise ValueError("Chat does not exist")
 
     if cid := next((x for x in u.chats if x.chat_id == chat_id), None):
-        remove_chat(db, cid)
+        await remove_chat(db, cid)
 
-    RedisChatMessageHistory(chat_id).clear()
-
-    client.delete(f"chat:{chat_id}")
-    client.srem("chats", chat_id)
+    with redis_client.pipeline(transaction=False) as pipe:
+        pipe.delete(_history_key(chat_id))
+        pipe.delete(f"chat:{chat_id}")
+        pipe.srem("chats", chat_id)
+        pipe.execute()
+    _chat_cache.pop(chat_id, None)
 
     return True
 
 
 @chat_router.delete("/delete/all")
-async def delete_all_chats(u: User = Depends(get_current_active_user), db: Session = Depends(get_db)):
-    [delete_chat(x.chat_id, u, db) for x in u.chats]
+async def delete_all_chats(u: User = Depends(get_current_active_user), db: AsyncSession = Depends(get_db)):
+    if not u.chats:
+        return True
+
+    await remove_chats(db, u.chats)
+
+    # drop every history, params key and set membership in a single round-trip
+    chat_ids = [x.chat_id for x in u.chats]
+    with redis_client.pipeline(transaction=False) as pipe:
+        for chat_id in chat_ids:
+            pipe.delete(_history_key(chat_id))
+            pipe.delete(f"chat:{chat_id}")
+        pipe.srem("chats", *chat_ids)
+        pipe.execute()
+    for chat_id in chat_ids:
+        _chat_cache.pop(chat_id, None)
+
     return True
 
 
 @chat_router.get("/{chat_id}/question")
 async def stream_ask_a_question(chat_id: str, prompt: str, u: User = Depends(get_current_active_user)):
-    if chat_id not in [x.chat_id for x in u.chats]:
+    if not _user_owns_chat(u, chat_id):
         raise unauth_error
 
-    logger.info("Starting redis client")
-
-    client = Redis(host="localhost", port=6379, decode_responses=False)
-
-    if not client.sismember("chats", chat_id):
-        raise ValueError("Chat does not exist")
-
     logger.debug("creating chat")
-    chat = _try_get_chat(client, chat_id)
+    chat = _try_get_chat(redis_client, chat_id)
 
     logger.debug(chat.params)
     logger.debug("creating history")
-    history = RedisChatMessageHistory(chat.id)
+    history = _history(chat.id)
 
     if len(prompt) > 0:
         logger.debug(f"adding question {prompt}")
@@ -241,13 +340,7 @@ async def stream_ask_a_question(chat_id: str, prompt: str, u: User = Depends(get
 
     logger.debug("creating Llama client")
     try:
-        llama_client = Llama(
-            model_path=f"/usr/src/app/weights/{chat.params.model_path}.bin",
-            n_ctx=len(chat.params.init_prompt) + chat.params.n_ctx,
-            n_gpu_layers=chat.params.n_gpu_layers,
-            n_threads=chat.params.n_threads,
-            last_n_tokens_size=chat.params.last_n_tokens_size,
-        )
+        llama_client = await _get_llama(chat.params)
     except ValueError as e:
         error = e.__str__()
         logger.error(error)
@@ -255,31 +348,57 @@ async def stream_ask_a_question(chat_id: str, prompt: str, u: User = Depends(get
         return {"event": "error"}
 
     # Following logic triggers if deleting before any tokens are generated
-    if client.get(f"stop_generation:{chat_id}"):
-        client.delete(f"stop_generation:{chat_id}")
+    if redis_client.get(f"stop_generation:{chat_id}"):
+        redis_client.delete(f"stop_generation:{chat_id}")
         return {"event": "close"}
 
-    def event_generator():
-        full_answer = ""
+    async def event_generator():
+        loop = asyncio.get_running_loop()
+        outputs = asyncio.Queue()
+        stop_generating = threading.Event()
+
+        def generate():
+            # Runs on LLAMA_EXECUTOR and hands every output (or the error) back to the event loop.
+            # The per-token Redis checks live here too so they never block the loop.
+            has_generated = False
+            try:
+                for output in llama_client(
+                    prompt,
+                    stream=True,
+                    temperature=chat.params.temperature,
+                    top_p=chat.params.top_p,
+                    top_k=chat.params.top_k,
+                    repeat_penalty=chat.params.repeat_penalty,
+                    max_tokens=chat.params.max_tokens,
+                ):
+                    if stop_generating.is_set():
+                        break
+                    if redis_client.get(f"stop_generation:{chat_id}"):
+                        logger.info("Generation stopped by user")
+                        redis_client.delete(f"stop_generation:{chat_id}")
+                        stop_generating.set()
+                        break
+                    if not has_generated:
+                        redis_client.set(f"has_generated:{chat_id}", "1")
+                        has_generated = True
+                    loop.call_soon_threadsafe(outputs.put_nowait, output)
+            except Exception as e:
+                loop.call_soon_threadsafe(outputs.put_nowait, e)
+            finally:
+                if has_generated:
+                    redis_client.delete(f"has_generated:{chat_id}")
+                loop.call_soon_threadsafe(outputs.put_nowait, None)
+
+        loop.run_in_executor(LLAMA_EXECUTOR, generate)
+
+        answer_parts = []
         error = None
         try:
-            for output in llama_client(
-                prompt,
-                stream=True,
-                temperature=chat.params.temperature,
-                top_p=chat.params.top_p,
-                top_k=chat.params.top_k,
-                repeat_penalty=chat.params.repeat_penalty,
-                max_tokens=chat.params.max_tokens,
-            ):
-                if client.get(f"stop_generation:{chat_id}"):
-                    logger.info("Generation stopped by user")
-                    client.delete(f"stop_generation:{chat_id}")
-                    break
-                elif not client.get(f"has_generated:{chat_id}"):
-                    client.set(f"has_generated:{chat_id}", "1")
+            while (output := await outputs.get()) is not None:
+                if isinstance(output, Exception):
+                    raise output
                 txt = output["choices"][0]["text"]
-                full_answer += txt
+                answer_parts.append(txt)
                 yield {"event": "message", "data": txt}
 
         except Exception as e:
@@ -290,7 +409,8 @@ async def stream_ask_a_question(chat_id: str, prompt: str, u: User = Depends(get
                 logger.error(error)
                 yield ({"event": "error"})
         finally:
-            client.delete(f"has_generated:{chat_id}")
+            stop_generating.set()
+            full_answer = "".join(answer_parts)
             if error:
                 history.append(SystemMessage(content=error))
             elif full_answer:
@@ -304,16 +424,11 @@ async def stream_ask_a_question(chat_id: str, prompt: str, u: User = Depends(get
 
 @chat_router.post("/{chat_id}/question")
 async def ask_a_question(chat_id: str, prompt: str, u: User = Depends(get_current_active_user)):
-    if chat_id not in [x.chat_id for x in u.chats]:
+    if not _user_owns_chat(u, chat_id):
         raise unauth_error
 
-    client = Redis(host="localhost", port=6379, decode_responses=False)
-
-    if not client.sismember("chats", chat_id):
-        raise ValueError("Chat does not exist")
-
-    chat = _try_get_chat(client, chat_id)
-    history = RedisChatMessageHistory(chat.id)
+    chat = _try_get_chat(redis_client, chat_id)
+    history = _history(chat.id)
 
     if len(prompt) > 0:
         human_message = HumanMessage(content=prompt)
@@ -323,20 +438,18 @@ async def ask_a_question(chat_id: str, prompt: str, u: User = Depends(get_curren
     prompt += "### Response:\n"
 
     try:
-        client = Llama(
-            model_path=f"/usr/src/app/weights/{chat.params.model_path}.bin",
-            n_ctx=len(chat.params.init_prompt) + chat.params.n_ctx,
-            n_threads=chat.params.n_threads,
-            n_gpu_layers=chat.params.n_gpu_layers,
-            last_n_tokens_size=chat.params.last_n_tokens_size,
-        )
-        answer = client(
-            prompt,
-            temperature=chat.params.temperature,
-            top_p=chat.params.top_p,
-            top_k=chat.params.top_k,
-            repeat_penalty=chat.params.repeat_penalty,
-            max_tokens=chat.params.max_tokens,
+        llama = await _get_llama(chat.params)
+        answer = await asyncio.get_running_loop().run_in_executor(
+            LLAMA_EXECUTOR,
+            partial(
+                llama,
+                prompt,
+                temperature=chat.params.temperature,
+                top_p=chat.params.top_p,
+                top_k=chat.params.top_k,
+                repeat_penalty=chat.params.repeat_penalty,
+                max_tokens=chat.params.max_tokens,
+            ),
         )
         full_answer = ""
         if len(answer.get("choices", [])) > 0:
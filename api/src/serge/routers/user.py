@@ -5,7 +5,7 @@ from serge.crud import create_user, update_user
 from serge.database import SessionLocal
 from serge.routers.auth import get_current_active_user
 from serge.schema import user as user_schema
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
 user_router = APIRouter(
     prefix="/user",
@@ -13,12 +13,9 @@ user_router = APIRouter(
 )
 
 
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 
 @user_router.get("/", response_model=user_schema.User)
@@ -33,9 +30,9 @@ async def get_user(u: user_schema.User = Depends(get_current_active_user)):
 
 
 @user_router.post("/create", response_model=user_schema.User)
-async def create_user_with_pass(ua: user_schema.UserAuth, db: Session = Depends(get_db)):
+async def create_user_with_pass(ua: user_schema.UserAuth, db: AsyncSession = Depends(get_db)):
     try:
-        u = create_user(db, ua)
+        u = await create_user(db, ua)
     except Exception as e:
         logging.exception(e)
         raise HTTPException(
@@ -54,10 +51,10 @@ async def create_user_with_pass(ua: user_schema.UserAuth, db: Session = Depends(
 async def self_update_user(
     new_data: user_schema.User,
     current: user_schema.User = Depends(get_current_active_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
     current.email = new_data.email
     current.full_name = new_data.full_name
     current.default_prompt = new_data.default_prompt
-    update_user(db, current)
+    await update_user(db, current)
     return current.to_public_dict()